@@ -11,13 +11,164 @@ MODIFICATION HISTORY:
 '''
 
 ### Module import ###
+import functools
 import numpy as np # for array manipulation and basic scientific calculation
 import xarray as xr # To read NetCDF files
-from scipy.interpolate import griddata # Simple regridding
+import dask # To regrid the time slices in parallel
+from scipy.spatial import Delaunay, cKDTree # Triangulation / nearest neighbor of the SE columns
+from scipy.sparse import csr_matrix # To store the interpolation weights
 from netCDF4 import Dataset # To write NetCDF files
 
 #================================================================================================
-def rewrite_ne30_1latlongrid_forCONUS_surflayer(diri,filename,varlist,savefilePath):
+def linear_interp_weights(mdllon,mdllat,X,Y,halo=5,fill_boundary=None):
+    """
+    This function computes the weights of a linear (barycentric) interpolation from the model columns to a regular grid
+    Same result as griddata(..., method='linear'), but the weights are computed only once and can be applied to any field
+    
+        Input:
+            mdllon, mdllat: lon/lat of the model columns (ncol)
+            X, Y: 2-D lon/lat of the target grid (from np.meshgrid)
+            halo: margin (degree) around the target grid; only model columns within it are triangulated
+            fill_boundary: None (default) or 'nearest' to use the nearest model column outside the model convex hull
+            
+        Output:
+            W: sparse matrix (n_target, ncol) with 3 weights per row
+               target points outside the model convex hull get nan weights, so W @ field is nan there (as griddata),
+               unless fill_boundary='nearest'
+        
+        Use example:
+            W = linear_interp_weights(mdllon,mdllat,X,Y)
+            vari_vals = (W @ ds_CONUS.isel(time=0,lev=31)[vari].values).reshape(X.shape)
+        
+    """
+    if fill_boundary not in (None, 'nearest'):
+        raise ValueError(f"fill_boundary must be None or 'nearest', got {fill_boundary!r}")
+    
+    mdllon = np.asarray(mdllon)
+    mdllat = np.asarray(mdllat)
+    targets = np.column_stack([X.ravel(), Y.ravel()])
+    
+    # keep only the model columns around the target grid; the halo keeps the target points inside the convex hull
+    idx = np.where((mdllon >= X.min()-halo) & (mdllon <= X.max()+halo) &
+                   (mdllat >= Y.min()-halo) & (mdllat <= Y.max()+halo))[0]
+    
+    # triangulate the model columns and locate the triangle of each target point
+    points = np.column_stack([mdllon[idx], mdllat[idx]])
+    tri = Delaunay(points)
+    simplex = tri.find_simplex(targets)
+    outside = simplex < 0
+    simplex[outside] = 0 # any triangle; the weights are set to nan below
+    
+    # barycentric coordinates of each target point in its triangle
+    trans = tri.transform[simplex]
+    bary = np.einsum('nij,nj->ni', trans[:,:2,:], targets - trans[:,2,:])
+    weights = np.column_stack([bary, 1 - bary.sum(axis=1)])
+    weights[outside,:] = np.nan
+    cols = idx[tri.simplices[simplex]] # columns refer to the full ncol dimension
+    
+    # outside the convex hull: take the value of the nearest model column
+    if fill_boundary == 'nearest' and outside.any():
+        _, nn_idx = cKDTree(points).query(targets[outside], k=1)
+        weights[outside,:] = [1, 0, 0]
+        cols[outside,:] = idx[nn_idx][:,None] # all 3 entries, so a nan elsewhere does not leak in (0*nan)
+    
+    ntarget = len(targets)
+    W = csr_matrix((weights.ravel(), cols.ravel(), np.arange(0,3*ntarget+1,3)),
+                   shape=(ntarget, len(mdllon)))
+    
+    return W
+
+#================================================================================================
+@functools.lru_cache(maxsize=None)
+def target_latlongrid(resolution,lon0=210,lon1=310,lat0=0,lat1=70):
+    """
+    This function defines the regular lat and lon grid over CONUS used by the rewrite functions
+    The grid is cached, so it is built only once for each resolution (arrays are read-only)
+    
+        Input:
+            resolution: grid spacing (degree)
+            lon0, lon1, lat0, lat1: bounds of the grid (degree)
+            
+        Output:
+            lon2d, lat2d: 1-D lon and lat of the grid
+            X, Y: 2-D lon and lat of the grid (from np.meshgrid)
+        
+        Use example:
+            lon2d, lat2d, X, Y = target_latlongrid(0.125)
+        
+    """
+    lon2d = np.arange(lon0,lon1+resolution,resolution)
+    lat2d = np.arange(lat0,lat1+resolution,resolution)
+    
+    # This will put lat and lon into arrays
+    X, Y = np.meshgrid(lon2d,lat2d)
+    
+    for arr in (lon2d, lat2d, X, Y):
+        arr.setflags(write=False)
+    
+    return lon2d, lat2d, X, Y
+
+# interpolation weights already computed, keyed by the model and target grids
+_interp_weights_cache = {}
+
+#================================================================================================
+def get_interp_weights(mdllon,mdllat,X,Y,fill_boundary=None):
+    """
+    This function returns the weights of linear_interp_weights, computed only once for a given model grid and target grid
+    (e.g., several files or several calls on the same ne0CONUSne30x8 output)
+    
+        Input:
+            mdllon, mdllat: lon/lat of the model columns (ncol)
+            X, Y: 2-D lon/lat of the target grid (from target_latlongrid)
+            fill_boundary: see linear_interp_weights
+            
+        Output:
+            W: sparse matrix (n_target, ncol), see linear_interp_weights
+        
+        Use example:
+            W = get_interp_weights(mdllon,mdllat,X,Y)
+        
+    """
+    mdllon = np.ascontiguousarray(mdllon)
+    mdllat = np.ascontiguousarray(mdllat)
+    
+    key = (X.shape, hash(X.tobytes()), hash(Y.tobytes()), len(mdllon), hash(mdllon.tobytes()), hash(mdllat.tobytes()), fill_boundary)
+    if key not in _interp_weights_cache:
+        _interp_weights_cache[key] = linear_interp_weights(mdllon,mdllat,X,Y,fill_boundary=fill_boundary)
+    
+    return _interp_weights_cache[key]
+
+#================================================================================================
+def apply_interp_weights(W,vari_vals,grid_shape):
+    """
+    This function applies the interpolation weights to every time slice of a variable
+    Time slices are independent, so they are regridded in parallel with dask threads (the sparse product releases the GIL)
+    
+        Input:
+            W: output of linear_interp_weights
+            vari_vals: values of the variable on the model columns, array (time, ncol)
+            grid_shape: (nlat, nlon) of the target grid
+            
+        Output:
+            float32 array (time, nlat, nlon) of the regridded variable (nan outside the model convex hull)
+        
+        Use example:
+            vari_timearray = apply_interp_weights(W,surf[vari].values,X.shape)
+        
+    """
+    # no need to initialize: every cell is written, including the nan outside the convex hull
+    vari_timearray = np.empty((len(vari_vals),)+tuple(grid_shape), dtype=np.float32)
+    
+    @dask.delayed
+    def regrid_one(timeidx):
+        vari_timearray[timeidx] = (W @ vari_vals[timeidx]).reshape(grid_shape) #... using linear interpolation
+    
+    dask.compute(*[regrid_one(timeidx) for timeidx in range(len(vari_vals))], scheduler='threads')
+    
+    return vari_timearray
+
+#================================================================================================
+def rewrite_ne30_1latlongrid_forCONUS_surflayer(diri,filename,varlist,savefilePath,fill_boundary=None):
     """
     This function re-write the output from ne30 grid to a regular 1x1 degree lat and lon grid over CONUS
     Select lev=31 since the pressure system is positive down
@@ -26,6 +177,7 @@ def rewrite_ne30_1latlongrid_forCONUS_surflayer(diri,filename,varlist,savefilePa
             Method: linear interpolation
             varlist: variables to re-grid
             savefilePath: path to the written .nc file (if == False would not save the output)
+            fill_boundary: None (default, nan outside the model convex hull) or 'nearest' to fill with the nearest model column
             
         Output:
             .nc file for the regrid dataset
@@ -36,18 +188,14 @@ def rewrite_ne30_1latlongrid_forCONUS_surflayer(diri,filename,varlist,savefilePa
     """
     # Define the lat/lon for desired grid 
     resolution = 1
-    lon2d = np.arange(210,310+resolution,resolution)
-    lat2d = np.arange(0,70+resolution,resolution)
+    lon2d, lat2d, X, Y = target_latlongrid(resolution)
     
-    # This will put lat and lon into arrays
-    X, Y = np.meshgrid(lon2d,lat2d)
-    
-    # empty dataset to store 
-    allvars_ds = xr.Dataset()
+    # regridded variables to store 
+    out_vars = {}
     
     #-------------
     # get data on ncol, original output from the simulations
-    ds_CONUS = xr.open_dataset(diri+filename)
+    ds_CONUS = xr.open_dataset(diri+filename, chunks={'time': 24})
     
     time_ar = ds_CONUS.time.values
     
@@ -55,21 +203,18 @@ def rewrite_ne30_1latlongrid_forCONUS_surflayer(diri,filename,varlist,savefilePa
     mdllat = ds_CONUS['lat']
     mdllon = ds_CONUS['lon']
     
-    for varidx in range(len(varlist)):
-        vari = varlist[varidx]
-        # regrid for this variable for the surface level; here the level using hybrid pressure positive down, so lev=31 is the surface layer
-        vari_timearray = np.zeros([len(time_ar),len(lat2d),len(lon2d)])
-        vari_timearray[:,:,:] = np.nan # initialize with nan
-        
-        # if there are multiple times
-        for timeidx in range(len(time_ar)):
-            vari_vals = griddata((mdllon,mdllat), ds_CONUS.isel(time=timeidx,lev=31)[vari], (X, Y), method='linear') #... using linear interpolation
-            # add to the array
-            vari_timearray[timeidx,:,:] = vari_vals
+    # interpolation weights are the same for every variable and time (and cached for the same grids)
+    W = get_interp_weights(mdllon,mdllat,X,Y,fill_boundary=fill_boundary)
+    
+    # read the surface layer of all variables once; here the level using hybrid pressure positive down, so lev=31 is the surface layer
+    surf = ds_CONUS[varlist].isel(lev=31).load()
+    
+    for vari in varlist:
+        # regrid for this variable for the surface level
+        vari_timearray = apply_interp_weights(W,surf[vari].values,(len(lat2d),len(lon2d)))
         
-        # write to dataset for vari
-        regrid_ds = xr.Dataset({
-                    vari: xr.DataArray(
+        # store the DataArray for vari
+        out_vars[vari] = xr.DataArray(
                                 data   = vari_timearray,
                                 dims   = ['time','lat','lon'],
                                 coords = {'time':time_ar,'lat': lat2d,'lon': lon2d},
@@ -78,26 +223,25 @@ def rewrite_ne30_1latlongrid_forCONUS_surflayer(diri,filename,varlist,savefilePa
                                     'long_name': ds_CONUS[vari].long_name
                                         }
                                     )
-                                },
-                        attrs = {'description': 'near surface estimated using linear interpolation'}
-                    )
-        # merge for all var
-        if varidx==0:
-            allvars_ds = regrid_ds
-        else:
-            # merge
-            allvars_ds = xr.merge([allvars_ds, regrid_ds], compat='override')
+    
+    # build the dataset for all var at once
+    description = 'near surface estimated using linear interpolation'
+    if fill_boundary == 'nearest':
+        description += ' (nearest neighbor outside the model convex hull)'
+    allvars_ds = xr.Dataset(out_vars, attrs = {'description': description})
             
     # save
     if savefilePath!=False:
         fullpathname_OUT = savefilePath+'CONUSRegrid1_'+filename #+'.nc'
-        allvars_ds.to_netcdf(fullpathname_OUT)
+        # compressed float32, one chunk per time slice
+        encoding = {vari: {'zlib': True, 'complevel': 4, 'dtype': 'float32', 'chunksizes': (1, len(lat2d), len(lon2d))} for vari in varlist}
+        allvars_ds.to_netcdf(fullpathname_OUT, encoding=encoding)
         print("save to:",fullpathname_OUT)
         
     return allvars_ds
 
 #================================================================================================
-def rewrite_ne0CONUSne30x8_0125latlongrid_forCONUS_surflayer_v2(ds_CONUS,varlist,savefilePath,filename):
+def rewrite_ne0CONUSne30x8_0125latlongrid_forCONUS_surflayer_v2(ds_CONUS,varlist,savefilePath,filename,fill_boundary=None):
     """
     This function re-write the output from ne0CONUSne30x8 grid to a regular 0.125 x 0.125 lat and lon grid 
     Select lev=31 since the pressure system is positive down
@@ -107,6 +251,7 @@ def rewrite_ne0CONUSne30x8_0125latlongrid_forCONUS_surflayer_v2(ds_CONUS,varlist
             varlist: variables to re-grid
             savefilePath: path to the written .nc file (if == False would not save the output)
             filename: name of the saved file
+            fill_boundary: None (default, nan outside the model convex hull) or 'nearest' to fill with the nearest model column
             
         Output:
             .nc file for the regrid dataset
@@ -121,14 +266,10 @@ def rewrite_ne0CONUSne30x8_0125latlongrid_forCONUS_surflayer_v2(ds_CONUS,varlist
     """
     # Define the lat/lon for desired grid 
     resolution = 0.125
-    lat2d = np.arange(0,70+resolution,resolution)
-    lon2d = np.arange(210,310+resolution,resolution)
+    lon2d, lat2d, X, Y = target_latlongrid(resolution)
     
-    # This will put lat and lon into arrays
-    X, Y = np.meshgrid(lon2d,lat2d)
-    
-    # empty dataset to store 
-    allvars_ds = xr.Dataset()
+    # regridded variables to store 
+    out_vars = {}
     
     #-------------
     
@@ -138,21 +279,18 @@ def rewrite_ne0CONUSne30x8_0125latlongrid_forCONUS_surflayer_v2(ds_CONUS,varlist
     mdllat = ds_CONUS['lat']
     mdllon = ds_CONUS['lon']
     
-    for varidx in range(len(varlist)):
-        vari = varlist[varidx]
-        # regrid for this variable for the surface level; here the level using hybrid pressure positive down, so lev=31 is the surface layer
-        vari_timearray = np.zeros([len(time_ar),len(lat2d),len(lon2d)])
-        vari_timearray[:,:,:] = np.nan # initialize with nan
-        
-        # if there are multiple times
-        for timeidx in range(len(time_ar)):
-            vari_vals = griddata((mdllon,mdllat), ds_CONUS.isel(time=timeidx,lev=31)[vari], (X, Y), method='linear') #... using linear interpolation
-            # add to the array
-            vari_timearray[timeidx,:,:] = vari_vals
+    # interpolation weights are the same for every variable and time (and cached for the same grids)
+    W = get_interp_weights(mdllon,mdllat,X,Y,fill_boundary=fill_boundary)
+    
+    # read the surface layer of all variables once; here the level using hybrid pressure positive down, so lev=31 is the surface layer
+    surf = ds_CONUS[varlist].isel(lev=31).load()
+    
+    for vari in varlist:
+        # regrid for this variable for the surface level
+        vari_timearray = apply_interp_weights(W,surf[vari].values,(len(lat2d),len(lon2d)))
         
-        # write to dataset for vari
-        regrid_ds = xr.Dataset({
-                    vari: xr.DataArray(
+        # store the DataArray for vari
+        out_vars[vari] = xr.DataArray(
                                 data   = vari_timearray,
                                 dims   = ['time','lat','lon'],
                                 coords = {'time':time_ar,'lat': lat2d,'lon': lon2d},
@@ -161,26 +299,25 @@ def rewrite_ne0CONUSne30x8_0125latlongrid_forCONUS_surflayer_v2(ds_CONUS,varlist
                                     'long_name': ds_CONUS[vari].long_name
                                         }
                                     )
-                                },
-                        attrs = {'description': 'near surface estimated using linear interpolation'}
-                    )
-        # merge for all var
-        if varidx==0:
-            allvars_ds = regrid_ds
-        else:
-            # merge
-            allvars_ds = xr.merge([allvars_ds, regrid_ds], compat='override')
+    
+    # build the dataset for all var at once
+    description = 'near surface estimated using linear interpolation'
+    if fill_boundary == 'nearest':
+        description += ' (nearest neighbor outside the model convex hull)'
+    allvars_ds = xr.Dataset(out_vars, attrs = {'description': description})
             
     # save
     if savefilePath!=False:
         fullpathname_OUT = savefilePath+'CONUSRegrid0125_'+filename+'.nc'
-        allvars_ds.to_netcdf(fullpathname_OUT)
+        # compressed float32, one chunk per time slice
+        encoding = {vari: {'zlib': True, 'complevel': 4, 'dtype': 'float32', 'chunksizes': (1, len(lat2d), len(lon2d))} for vari in varlist}
+        allvars_ds.to_netcdf(fullpathname_OUT, encoding=encoding)
         print("save to:",fullpathname_OUT)
         
     return allvars_ds
 
 #================================================================================================
-def rewrite_ne0CONUSne30x8_0125latlongrid_forCONUS_surflayer(diri,filename,varlist,savefilePath):
+def rewrite_ne0CONUSne30x8_0125latlongrid_forCONUS_surflayer(diri,filename,varlist,savefilePath,fill_boundary=None):
     """
     This function re-write the output from ne0CONUSne30x8 grid to a regular 0.125 x 0.125 lat and lon grid 
     Select lev=31 since the pressure system is positive down
@@ -189,6 +326,7 @@ def rewrite_ne0CONUSne30x8_0125latlongrid_forCONUS_surflayer(diri,filename,varli
             Method: linear interpolation
             varlist: variables to re-grid
             savefilePath: path to the written .nc file (if == False would not save the output)
+            fill_boundary: None (default, nan outside the model convex hull) or 'nearest' to fill with the nearest model column
             
         Output:
             .nc file for the regrid dataset
@@ -203,18 +341,14 @@ def rewrite_ne0CONUSne30x8_0125latlongrid_forCONUS_surflayer(diri,filename,varli
     """
     # Define the lat/lon for desired grid 
     resolution = 0.125
-    lat2d = np.arange(0,70+resolution,resolution)
-    lon2d = np.arange(210,310+resolution,resolution)
-    
-    # This will put lat and lon into arrays
-    X, Y = np.meshgrid(lon2d,lat2d)
+    lon2d, lat2d, X, Y = target_latlongrid(resolution)
     
-    # empty dataset to store 
-    allvars_ds = xr.Dataset()
+    # regridded variables to store 
+    out_vars = {}
     
     #-------------
     # get data on ncol, original output from the simulations
-    ds_CONUS = xr.open_dataset(diri+filename)
+    ds_CONUS = xr.open_dataset(diri+filename, chunks={'time': 24})
     
     time_ar = ds_CONUS.time.values
     
@@ -222,21 +356,18 @@ def rewrite_ne0CONUSne30x8_0125latlongrid_forCONUS_surflayer(diri,filename,varli
     mdllat = ds_CONUS['lat']
     mdllon = ds_CONUS['lon']
     
-    for varidx in range(len(varlist)):
-        vari = varlist[varidx]
-        # regrid for this variable for the surface level; here the level using hybrid pressure positive down, so lev=31 is the surface layer
-        vari_timearray = np.zeros([len(time_ar),len(lat2d),len(lon2d)])
-        vari_timearray[:,:,:] = np.nan # initialize with nan
-        
-        # if there are multiple times
-        for timeidx in range(len(time_ar)):
-            vari_vals = griddata((mdllon,mdllat), ds_CONUS.isel(time=timeidx,lev=31)[vari], (X, Y), method='linear') #... using linear interpolation
-            # add to the array
-            vari_timearray[timeidx,:,:] = vari_vals
+    # interpolation weights are the same for every variable and time (and cached for the same grids)
+    W = get_interp_weights(mdllon,mdllat,X,Y,fill_boundary=fill_boundary)
+    
+    # read the surface layer of all variables once; here the level using hybrid pressure positive down, so lev=31 is the surface layer
+    surf = ds_CONUS[varlist].isel(lev=31).load()
+    
+    for vari in varlist:
+        # regrid for this variable for the surface level
+        vari_timearray = apply_interp_weights(W,surf[vari].values,(len(lat2d),len(lon2d)))
         
-        # write to dataset for vari
-        regrid_ds = xr.Dataset({
-                    vari: xr.DataArray(
+        # store the DataArray for vari
+        out_vars[vari] = xr.DataArray(
                                 data   = vari_timearray,
                                 dims   = ['time','lat','lon'],
                                 coords = {'time':time_ar,'lat': lat2d,'lon': lon2d},
@@ -245,20 +376,19 @@ def rewrite_ne0CONUSne30x8_0125latlongrid_forCONUS_surflayer(diri,filename,varli
                                     'long_name': ds_CONUS[vari].long_name
                                         }
                                     )
-                                },
-                        attrs = {'description': 'near surface estimated using linear interpolation'}
-                    )
-        # merge for all var
-        if varidx==0:
-            allvars_ds = regrid_ds
-        else:
-            # merge
-            allvars_ds = xr.merge([allvars_ds, regrid_ds], compat='override')
+    
+    # build the dataset for all var at once
+    description = 'near surface estimated using linear interpolation'
+    if fill_boundary == 'nearest':
+        description += ' (nearest neighbor outside the model convex hull)'
+    allvars_ds = xr.Dataset(out_vars, attrs = {'description': description})
             
     # save
     if savefilePath!=False:
         fullpathname_OUT = savefilePath+'CONUSRegrid0125_'+filename+'.nc'
-        allvars_ds.to_netcdf(fullpathname_OUT)
+        # compressed float32, one chunk per time slice
+        encoding = {vari: {'zlib': True, 'complevel': 4, 'dtype': 'float32', 'chunksizes': (1, len(lat2d), len(lon2d))} for vari in varlist}
+        allvars_ds.to_netcdf(fullpathname_OUT, encoding=encoding)
         print("save to:",fullpathname_OUT)
         
     return allvars_ds
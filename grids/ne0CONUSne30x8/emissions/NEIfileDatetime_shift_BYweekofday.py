@@ -7,8 +7,10 @@
 #=====Dependent library & functions======
 #--------------------------------------------------------------------------
 import os
+import calendar
 from datetime import datetime, timedelta
-from dateutil.relativedelta import relativedelta
+import numpy as np
+import pandas as pd
 
 from datetime import datetime
 def extract_date_and_time(filename):
@@ -23,7 +25,6 @@ def extract_date_and_time(filename):
 #=====The function======
 #--------------------------------------------------------------------------
 from datetime import datetime, timedelta
-from dateutil.relativedelta import relativedelta
 
 def NEIfileDatetime_shift_BYweekofday(inpNEIfile, outyear):
     """
@@ -39,18 +40,16 @@ def NEIfileDatetime_shift_BYweekofday(inpNEIfile, outyear):
     # Takes NEI file for the input datetime
     inp_date_time_obj = datetime.strptime(inpNEIfile[13:], '%Y-%m-%d_%H:%M:%S')
 
-    # get the years between input and output
-    nyears = outyear - inp_date_time_obj.year
-
     # find the date in the target year
-    outp_date_time_obj = inp_date_time_obj + relativedelta(years=nyears)
+    try:
+        outp_date_time_obj = inp_date_time_obj.replace(year=outyear)
+    except ValueError:
+        # Feb 29 in a non-leap target year
+        outp_date_time_obj = inp_date_time_obj.replace(year=outyear, day=28)
 
     # adjusted for week in a day
     delta_days = outp_date_time_obj - inp_date_time_obj
 
-    # Calculate the number of weeks to shift the weekday
-    num_weeks_shift = delta_days.days // 7
-
     # Calculate the number of remaining days after removing whole weeks
     remaining_days = delta_days.days % 7
 
@@ -76,6 +75,46 @@ def NEIfileDatetime_shift_BYweekofday(inpNEIfile, outyear):
 
 # outpNEIfile = NEIfileDatetime_shift_BYweekofday(inpNEIfile, outyear)
 
+#=====Vectorized version for a list of NEI files======
+#--------------------------------------------------------------------------
+
+def NEIfileDatetime_shift_BYweekofday_vec(inpNEIfiles, outyear):
+    """
+    Same as NEIfileDatetime_shift_BYweekofday, but for a list of NEI files at once (e.g., all hourly files in a year).
+
+    Parameters:
+        inpNEIfiles (list of str): NEI files with the input datetime in the format 'wrfchemi_d01_YYYY-MM-DD_HH:MM:SS'.
+        outyear (int): The target output year for the adjusted datetime.
+
+    Returns:
+        np.ndarray of str: The adjusted NEI filenames for the specified output year, in the same order as inpNEIfiles.
+    """
+    # Takes NEI files for the input datetimes
+    inp_date_time = pd.to_datetime([f[13:] for f in inpNEIfiles], format='%Y-%m-%d_%H:%M:%S')
+
+    # find the date in the target year; Feb 29 goes to Feb 28 if outyear is not a leap year (same as NEIfileDatetime_shift_BYweekofday)
+    day = np.where((inp_date_time.month == 2) & (inp_date_time.day == 29) & (not calendar.isleap(outyear)),
+                   28, inp_date_time.day)
+    outp_date_time = pd.DatetimeIndex(pd.to_datetime(pd.DataFrame({
+        'year': outyear,
+        'month': inp_date_time.month,
+        'day': day,
+        'hour': inp_date_time.hour,
+        'minute': inp_date_time.minute,
+        'second': inp_date_time.second,
+    })))
+
+    # remaining days after removing whole weeks
+    remaining_days = (outp_date_time - inp_date_time).days % 7
+
+    # then will shift the dates by 'remaining_days' to match the same day in a week
+    adjt_outp_date_time = outp_date_time - pd.to_timedelta(remaining_days, unit='D')
+
+    # return the NEI filenames after adjustment
+    outpNEIfiles = ('wrfchemi_d01_' + adjt_outp_date_time.strftime('%Y-%m-%d_%H:%M:%S')).to_numpy()
+
+    return outpNEIfiles
+
 # #=====Function to locate the 2017 NEI filename given the desired output date======
 # #--------------------------------------------------------------------------
 
@@ -93,18 +132,16 @@ def NEIfileDatetime_shift_BACKWARDto2017(outpNEIfile_datetime, outyear):
     # Takes outpNEIfile_datetime for the adjusted datetime
     outp_date_time_obj = datetime.strptime(outpNEIfile_datetime, '%Y-%m-%d_%H:%M:%S')
 
-    # Calculate the number of years between the output year and 2017
-    nyears = outp_date_time_obj.year - 2017
-
     # Find the date in the input year (2017)
-    inp_date_time_obj = outp_date_time_obj - relativedelta(years=nyears)
+    try:
+        inp_date_time_obj = outp_date_time_obj.replace(year=2017)
+    except ValueError:
+        # Feb 29 does not exist in 2017
+        inp_date_time_obj = outp_date_time_obj.replace(year=2017, day=28)
 
     # Adjust for the week in a day
     delta_days = outp_date_time_obj - inp_date_time_obj
 
-    # Calculate the number of weeks to shift the weekday
-    num_weeks_shift = delta_days.days // 7
-
     # Calculate the number of remaining days after removing whole weeks
     remaining_days = delta_days.days % 7
 
@@ -63,9 +63,9 @@ scalefactor = 0.7   # e.g. 0.7=70pct, 1.3=130pct
 #================================================================================================
 #### Module import ###
 import os
-import re
-import glob
 import fnmatch
+import functools
+import concurrent.futures
 from pathlib import Path
 
 import pandas as pd
@@ -83,20 +83,14 @@ out_diri = Path(Out_BBEmissions_diri)
 out_diri.mkdir(parents=True, exist_ok=True)
 print(f"Output directory ready: {out_diri}")
 
-# Find all bb emissions files
-pattern = os.path.join(
-    BBEmissions_diri,
-    "qfed.emis_*_hires_mol_2020-2024_c20250115.nc"
-)
-files = glob.glob(pattern)
-regex = re.compile(
-    r"qfed.emis_(?P<spc>.+?)_hires_mol_2020-2024_c20250115\.nc"
-)
-spc_list = [
-    regex.search(os.path.basename(f)).group("spc")
-    for f in files
-    if regex.search(os.path.basename(f))
-]
+# Find all bb emissions files; the species is the part between the prefix and the suffix
+file_prefix = "qfed.emis_"
+file_suffix = "_hires_mol_2020-2024_c20250115.nc"
+files = []
+spc_list = []
+for p in sorted(Path(BBEmissions_diri).glob(f"{file_prefix}*{file_suffix}")):
+    files.append(str(p))
+    spc_list.append(p.name.removeprefix(file_prefix).removesuffix(file_suffix))
 
 # Get the file(s) to modify
 if varname=='all':
@@ -105,7 +99,7 @@ if varname=='all':
 else:
     # for a single variable
     scalespc_list = [varname]
-    scalefiles = f'{BBEmissions_diri}qfed.emis_{varname}_hires_mol_2020-2024_c20250115.nc'
+    scalefiles = [f'{BBEmissions_diri}qfed.emis_{varname}_hires_mol_2020-2024_c20250115.nc']
     
 #================================================================================================
 # Grid and Mask Information
@@ -118,6 +112,9 @@ mask_da_loaded = mask_ds[regionMask].astype(bool)  # dims: (grid_size,) or (ncol
 if "grid_size" in mask_da_loaded.dims and "ncol" not in mask_da_loaded.dims:
     mask_da_loaded = mask_da_loaded.rename({"grid_size": "ncol"})
 
+# Plain numpy copy of the mask (ncol order): used for scaling, cheap to pass to workers
+mask_np = np.ascontiguousarray(mask_da_loaded.values, dtype=bool)
+
 # Coordinate-like vars to clean attributes (and fill NaN only if numeric)
 coord_like_vars = {'time', 'ncol', 'lat', 'lon', 'area', 'date', 'altitude', 'rrfac'}
 
@@ -153,7 +150,7 @@ def scale_bb_emissions_by_mask(
         Directory containing original emission files.
     out_diri : str
         Directory to write scaled emission files.
-    mask_da : xr.DataArray (bool)
+    mask_da : np.ndarray or xr.DataArray (bool)
         Boolean mask on the same 'ncol' grid (True = region to scale).
     scalefactor : float
         Multiplicative factor applied inside the mask.
@@ -183,7 +180,8 @@ def scale_bb_emissions_by_mask(
         spc_fileINpath = (
             f"{in_diri}qfed.emis_{spc}_hires_mol_2020-2024_c20250115.nc"
         )
-        spci_ds = xr.open_dataset(spc_fileINpath)
+        # read by weekly chunks of hourly data; the scaling below stays lazy
+        spci_ds = xr.open_dataset(spc_fileINpath, chunks={"time": 168})
 
         # --------------------------------------------------
         # Optional: adjust longitudes (0–360 → -180–180)
@@ -201,8 +199,10 @@ def scale_bb_emissions_by_mask(
         # --------------------------------------------------
         # Apply regional scaling
         # inside mask:  value * scalefactor
-        # outside mask: unchanged
+        # outside mask: unchanged (value * 1)
         # --------------------------------------------------
+        scale_vec = np.where(np.asarray(mask_da, dtype=bool), float(scalefactor), 1.0)
+
         for var in spci_ds.data_vars:
 
             if var in coord_like_vars:
@@ -214,7 +214,17 @@ def scale_bb_emissions_by_mask(
             if "ncol" not in da.dims:
                 continue
 
-            spci_ds[var] = da.where(~mask_da, other=da * scalefactor)
+            # multiply the underlying (lazy) array directly, broadcast along ncol;
+            # no xarray alignment. Float variables keep their dtype; others
+            # (e.g. integers) are promoted, a factor 0.7 must not become 0
+            if np.issubdtype(da.dtype, np.floating):
+                scale_b = scale_vec.astype(da.dtype)
+            else:
+                scale_b = scale_vec
+            scale_b = scale_b.reshape(
+                [-1 if dim == "ncol" else 1 for dim in da.dims]
+            )
+            spci_ds[var] = (da.dims, da.data * scale_b, da.attrs)
 
             # Record scaling metadata
             spci_ds[var].attrs.update({
@@ -236,7 +246,21 @@ def scale_bb_emissions_by_mask(
             f"{out_diri}qfed.emis_{spc}_hires_mol_2020-2024_c20250115.nc"
         )
 
-        spci_ds.to_netcdf(spc_fileOUTpath)
+        # compressed output, chunked by week along time
+        encoding = {
+            var: {
+                "zlib": True,
+                "complevel": 4,
+                "chunksizes": tuple(
+                    min(168, n) if dim == "time" else n
+                    for dim, n in zip(spci_ds[var].dims, spci_ds[var].shape)
+                ),
+            }
+            for var in spci_ds.data_vars
+            if "ncol" in spci_ds[var].dims
+        }
+
+        spci_ds.to_netcdf(spc_fileOUTpath, encoding=encoding)
 
         print(f"Saved scaled emissions: {spc_fileOUTpath}")
         print("*" * 72)
@@ -249,13 +273,21 @@ def scale_bb_emissions_by_mask(
 # # ----------------------------
 # # Scale emissions within mask
 # # ----------------------------
-# for spc in scalespc_list:
-#     scale_bb_emissions_by_mask(
-#         spc,
-#         BBEmissions_diri,
-#         Out_BBEmissions_diri,
-#         mask_da_loaded,
-#         scalefactor,
-#         regionMask,
-#         coord_like_vars,
-#     )
\ No newline at end of file
+# # Each species is an independent file, so process them in parallel
+# # (the mask is passed as a plain numpy array to keep the pickling cheap)
+# if __name__ == "__main__":
+#     with concurrent.futures.ProcessPoolExecutor(
+#         max_workers=min(len(scalespc_list), os.cpu_count())
+#     ) as ex:
+#         list(ex.map(
+#             functools.partial(
+#                 scale_bb_emissions_by_mask,
+#                 in_diri=BBEmissions_diri,
+#                 out_diri=os.path.join(Out_BBEmissions_diri, ""),
+#                 mask_da=mask_np,
+#                 scalefactor=scalefactor,
+#                 regionMask=regionMask,
+#                 coord_like_vars=coord_like_vars,
+#             ),
+#             scalespc_list,
+#         ))
\ No newline at end of file
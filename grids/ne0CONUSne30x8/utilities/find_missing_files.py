@@ -2,8 +2,9 @@
 Functions to identify missing hourly emissions or chemistry files within a specified datetime range.
 
 This script generates the expected hourly filenames between two timestamps
-and checks whether each file exists in the target directory. It returns
-both the list of expected files and any missing files.
+and checks whether each file exists in the target directory (listed once,
+instead of probing every file). It returns both the expected files (tuple)
+and the missing files (frozenset, for fast membership tests).
 
 Designed for use in atmospheric chemistry and emissions workflows
 (e.g., WRF-Chem, CAMS, MUSICA processing).
@@ -14,128 +15,333 @@ Madankui Tao
 Created: 2026-02
 """
 
-from datetime import datetime, timedelta
+import os
+import stat
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-def find_missing_files_v1(startDatetime, endDatetime, filedir, file_prefix):
+import numpy as np
+
+# Directory listings already read, reused with use_cache=True by repeated calls on the
+# same filedir (e.g., several species or domains): {filedir: (time read, directory mtime, {file name: os.DirEntry})}
+DIR_CACHE_TTL = 60  # seconds
+_dir_cache = {}
+
+# Paths found missing by the per-file checks, not checked again while recent with
+# use_cache=True (same TTL, directory unchanged since): {file path: (time checked, directory mtime)}
+NEGATIVE_CACHE_MAX = 100000  # entries
+_negative_cache = {}
+
+def _list_dir(filedir, use_cache=False):
+    """
+    Return the regular files of filedir (symlinks to one included) as a dict
+    {file name: os.DirEntry} (empty if filedir does not exist or is not a directory).
+    Do not modify the returned dict.
+
+    Subdirectories and dangling symlinks are left out, as they cannot be opened
+    as files. entry.is_file() needs no stat call except for symlinks.
+
+    The DirEntry objects cache their stat result: entry.stat() costs one stat call
+    the first time (on Linux), none afterwards.
+
+    With use_cache, a listing read less than DIR_CACHE_TTL seconds ago is reused,
+    unless the directory was modified since (files added or removed).
+    """
+    key = os.path.abspath(filedir)
+    try:
+        dir_stat = os.stat(key)
+    except FileNotFoundError:
+        return {}
+    if not stat.S_ISDIR(dir_stat.st_mode):
+        return {}
+    mtime = dir_stat.st_mtime_ns
+
+    now = time.monotonic()
+    if use_cache:
+        cached = _dir_cache.get(key)
+        if cached is not None and now - cached[0] < DIR_CACHE_TTL and cached[1] == mtime:
+            return cached[2]
+
+    with os.scandir(key) as it:
+        entries = {entry.name: entry for entry in it if entry.is_file()}
+    if use_cache:
+        _dir_cache[key] = (now, mtime, entries)
+
+    return entries
+
+def _isfile_all(filedir, expected_files, stat_threads=None, use_cache=False):
+    """
+    Check each expected file with os.path.isfile (single stat call, no file is opened),
+    in parallel threads. Return a boolean array, True where the file exists.
+
+    With use_cache, files found missing less than DIR_CACHE_TTL seconds ago are
+    reported missing again without a new check, unless the directory was modified since.
+
+    The files are checked in sorted (directory listing) order, which keeps the
+    dentry cache warm and the disk head moving one way; the result keeps the
+    order of expected_files.
+
+    If filedir does not exist (or is not a directory), every file is missing and
+    none of them is checked.
+    """
+    try:
+        dir_stat = os.stat(os.path.abspath(filedir))  # filedir '' is the current directory
+    except FileNotFoundError:
+        dir_stat = None
+    if dir_stat is None or not stat.S_ISDIR(dir_stat.st_mode):
+        return np.zeros(len(expected_files), dtype=bool)
+    mtime = dir_stat.st_mtime_ns
+
+    now = time.monotonic()
+    known_missing = np.zeros(len(expected_files), dtype=bool)
+    if use_cache:
+        for i, file_path in enumerate(expected_files):
+            cached = _negative_cache.get(file_path)
+            known_missing[i] = cached is not None and now - cached[0] < DIR_CACHE_TTL and cached[1] == mtime
+
+    to_check = expected_files[~known_missing]
+    # names from _iter_expected are already sorted (zero-padded timestamps), the stable sort is then linear
+    order = np.argsort(to_check, kind='stable')
+    if stat_threads is None:
+        stat_threads = min(32, len(to_check))
+    found = np.zeros(len(to_check), dtype=bool)
+    with ThreadPoolExecutor(max_workers=max(1, stat_threads)) as ex:
+        found[order] = list(ex.map(os.path.isfile, to_check[order]))
+
+    exists = np.zeros(len(expected_files), dtype=bool)
+    exists[~known_missing] = found
+
+    # update the negative cache (bounded: drop everything when full)
+    if use_cache:
+        for file_path, ok in zip(to_check, found):
+            if ok:
+                _negative_cache.pop(file_path, None)
+            else:
+                _negative_cache[file_path] = (now, mtime)
+        if len(_negative_cache) > NEGATIVE_CACHE_MAX:
+            _negative_cache.clear()
+
+    return exists
+
+def clear_cache():
+    """
+    Forget all cached directory listings and missing files.
+    """
+    _dir_cache.clear()
+    _negative_cache.clear()
+
+def _iter_expected(start_date, end_date, filedir, file_prefix, file_sufix='', date_sep='_', block_hours=24*31):
+    """
+    Yield the expected hourly files between start_date and end_date (datetime), block by block
+    (at most block_hours files at a time), as two numpy arrays: (file names, full paths).
+    Files come in chronological order, which is also alphabetical (directory listing) order.
+
+    Names are file_prefix + '_YYYY-MM-DD' + date_sep + 'HH:00:00' + file_sufix; the hours are
+    integer seconds from start_date (no datetime object per file), formatted by numpy
+    (no strftime per file), and the directory is joined once.
+    """
+    start = int(np.datetime64(start_date, 's').astype(np.int64))  # seconds since 1970-01-01
+    end = int(np.datetime64(end_date, 's').astype(np.int64))
+    n_hours = max(0, (end - start) // 3600 + 1)
+    dir_prefix = os.path.join(filedir, '')
+
+    for i in range(0, n_hours, block_hours):
+        seconds = start + np.arange(i, min(i + block_hours, n_hours), dtype=np.int64) * 3600
+        hours = seconds.astype('datetime64[s]').astype('datetime64[h]')
+        stamps = np.datetime_as_string(hours, unit='h')  # 'YYYY-MM-DDTHH'
+        if date_sep != 'T':
+            stamps = np.char.replace(stamps, 'T', date_sep)
+        file_names = np.char.add(np.char.add(file_prefix + '_', stamps), ':00:00' + file_sufix)
+        yield file_names, np.char.add(dir_prefix, file_names)
+
+def _to_datetime(value, fmt):
+    """
+    Return value as a datetime; strings are parsed with fmt, datetime objects are used as is.
+    """
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, fmt)
+
+def _find_missing(start_date, end_date, filedir, file_prefix, file_sufix='', date_sep='_',
+                  scan_dir=True, stat_threads=None, return_expected=True, verbose=False,
+                  return_stats=False, use_cache=False):
+    """
+    Core of find_missing_files_v1/v2: find the missing hourly files
+    file_prefix + '_YYYY-MM-DD' + date_sep + 'HH:00:00' + file_sufix in filedir
+    between start_date and end_date (datetime).
+
+    See find_missing_files_v1 for the other parameters and the returned dict.
+    """
+    # file_prefix may hold a directory part (e.g. 'sub/wrfchemi_d01'):
+    # the files are then looked for in that directory
+    filedir, file_prefix = os.path.split(os.path.join(filedir, file_prefix))
+
+    # Expected file names between start and end dates (hourly), generated a month at a time
+    expected_blocks = _iter_expected(start_date, end_date, filedir, file_prefix, file_sufix, date_sep)
+
+    if scan_dir:
+        # List the directory once (or reuse a recent listing), then check each expected file against it
+        entries = _list_dir(filedir, use_cache)
+
+    missing_files = []
+    expected_files = [] if return_expected else None
+    present_stats = {} if return_stats else None
+    for file_names, file_paths in expected_blocks:
+        if scan_dir:
+            # dict membership, O(1) per expected file (no sort of the listing per block)
+            exists = np.fromiter((file_name in entries for file_name in file_names.tolist()), bool, len(file_names))
+        else:
+            # Check each file with a single stat call, in parallel threads (skipping known missing files)
+            exists = _isfile_all(filedir, file_paths, stat_threads, use_cache)
+        if return_stats:
+            for i in np.flatnonzero(exists):
+                file_name, file_path = str(file_names[i]), str(file_paths[i])
+                try:
+                    present_stats[file_path] = entries[file_name].stat() if scan_dir else os.stat(file_path)
+                except OSError:
+                    # removed (or its symlink target removed) since it was found: missing after all
+                    exists[i] = False
+        missing_files.extend(file_paths[~exists].tolist())
+        if return_expected:
+            expected_files.append(file_paths)
+    if return_expected:
+        expected_files = tuple(file_path for block in expected_files for file_path in block.tolist())
+
+    #-----------
+    # Print the missing files (only on request, e.g. interactive use)
+    if verbose:
+        if len(missing_files)!=0:
+            print("Missing files:")
+            print('\n'.join(missing_files))
+        else:
+            print("No missing files found.")
+
+    result = {'missing_files':frozenset(missing_files),'expected_files':expected_files}
+    if return_stats:
+        result['present_stats'] = present_stats
+    return result
+
+def find_missing_files_v1(startDatetime, endDatetime, filedir, file_prefix, scan_dir=True, stat_threads=None, return_expected=True,
+                          verbose=False, return_stats=False, use_cache=False):
     """
     Find missing files between two given datetime strings. time in '%Y-%m-%d_%H:%M:%S'
 
     Parameters:
-        startDatetime (str): Start datetime in the format 'YYYY-MM-DD_HH:MM:SS'.
-        endDatetime (str): End datetime in the format 'YYYY-MM-DD_HH:MM:SS'.
+        startDatetime (str or datetime): Start datetime in the format 'YYYY-MM-DD_HH:MM:SS'.
+        endDatetime (str or datetime): End datetime in the format 'YYYY-MM-DD_HH:MM:SS'.
         filedir (str): the directory where the files are located.
         file_prefix (str): Prefix used in the file names.
+        scan_dir (bool): If True (default), list filedir once and match the expected names against it.
+            If False, check each expected file with os.path.isfile (better for huge directories
+            holding many unrelated files). Either way, a file is present if it can be opened as
+            a file: subdirectories and dangling symlinks count as missing.
+        stat_threads (int): Number of threads for the checks when scan_dir is False
+            (default: min(32, number of expected files)); useful on NFS/Lustre.
+        return_expected (bool): If False, the full array of expected files is not kept
+            (files are generated and checked a month at a time; 'expected_files' is None).
+        verbose (bool): If True, print the missing files (default: nothing is printed).
+        return_stats (bool): If True, also return the os.stat_result (size, mtime, ...) of each
+            present file, taken from the directory listing when scan_dir is True.
+        use_cache (bool): If True, reuse the directory listing (scan_dir True) or the files found
+            missing (scan_dir False) of a previous call on the same directory, for up to
+            DIR_CACHE_TTL seconds unless the directory mtime changed (see clear_cache). The mtime
+            is coarse (about 1 s on NFSv3), so a file created right after a call may be reported
+            missing, and its stats be stale, until the TTL expires. Default False: every call
+            checks the directory again.
 
     Returns:
-        list: List of missing file names.
+        dict: 'missing_files' (frozenset of missing file names, e.g. `if file in missing_files`;
+            use sorted() for chronological order) and
+            'expected_files' (tuple of all expected file names, in chronological order);
+            with return_stats, 'present_stats' ({file path: os.stat_result} of the present files,
+            keyed like 'expected_files').
+            With use_cache, the result may be up to DIR_CACHE_TTL seconds old (see use_cache).
 
     Example:
         startDatetime = '2018-07-01_03:00:00'
         endDatetime = '2018-07-03_00:00:00'
         file_prefix = 'wrfchemi_d01'
-        missing_files = find_missing_files_v1(startDatetime, endDatetime, file_prefix)
-        print(missing_files)  # Print the missing files.
+        missing_files = find_missing_files_v1(startDatetime, endDatetime, filedir, file_prefix, verbose=True)
     """
 
     # Convert startDatetime and endDatetime strings to datetime objects
-    start_date = datetime.strptime(startDatetime, '%Y-%m-%d_%H:%M:%S')
-    end_date = datetime.strptime(endDatetime, '%Y-%m-%d_%H:%M:%S')
-
-    # Create a list of expected file names between start and end dates
-    current_date = start_date
-    expected_files = []
-    while current_date <= end_date:
-        file_name = file_prefix + current_date.strftime('_%Y-%m-%d_%H:00:00')
-        expected_files.append(filedir+file_name)
-        current_date += timedelta(hours=1)
-
-    # Check if each file exists, and store the missing files in a list
-    missing_files = []
-    for file_path in expected_files:
-        try:
-            # Check if the file exists
-            with open(file_path, 'r'):
-                pass
-        except FileNotFoundError:
-            missing_files.append(file_path)
+    start_date = _to_datetime(startDatetime, '%Y-%m-%d_%H:%M:%S')
+    end_date = _to_datetime(endDatetime, '%Y-%m-%d_%H:%M:%S')
 
-    #-----------
-    # Print the missing files
-    if len(missing_files)!=0:
-        print("Missing files:")
-        for file_name in missing_files:
-            print(file_name)
-    else:
-        print("No missing files found.")
-            
-    return {'missing_files':missing_files,'expected_files':expected_files}
+    return _find_missing(start_date, end_date, filedir, file_prefix, date_sep='_',
+                         scan_dir=scan_dir, stat_threads=stat_threads, return_expected=return_expected,
+                         verbose=verbose, return_stats=return_stats, use_cache=use_cache)
 
 # # Example usage
 # startDatetime = '2017-07-01_03:00:00'
 # endDatetime = '2017-07-03_00:00:00'
 # filedir = '/net/fs09/d0/taoma528/CESM22/CAMS_withCONUS2017NEI/NEI2017_CONUS_output_01deg/'
 # file_prefix = 'wrfchemi_d01'
-# missing_files = find_missing_files_v1(startDatetime, endDatetime, filedir,file_prefix)
+# missing_files = find_missing_files_v1(startDatetime, endDatetime, filedir,file_prefix)['missing_files']
 
 # # Print the missing files
 # if missing_files:
 #     print("Missing files:")
-#     for file_name in missing_files:
+#     for file_name in sorted(missing_files):
 #         print(file_name)
 # else:
 #     print("No missing files found.")
 
 ### version two for different datetime 
-def find_missing_files_v2(startDatetime, endDatetime, filedir, file_prefix, file_sufix):
+def find_missing_files_v2(startDatetime, endDatetime, filedir, file_prefix, file_sufix, scan_dir=True, stat_threads=None, return_expected=True,
+                          verbose=False, return_stats=False, use_cache=False):
     """
     Find missing files between two given datetime strings.
 
     Parameters:
-        startDatetime (str): Start datetime in the format 'YYYY-MM-DDTHH:MM:SS'.
-        endDatetime (str): End datetime in the format 'YYYY-MM-DD_HH:MM:SS'.
+        startDatetime (str or datetime): Start datetime in the format 'YYYY-MM-DDTHH:MM:SS'.
+        endDatetime (str or datetime): End datetime in the format 'YYYY-MM-DDTHH:MM:SS'.
         filedir (str): the directory where the files are located.
         file_prefix (str): Prefix used in the file names.
+        file_sufix (str): Suffix used in the file names (e.g., '.nc').
+        scan_dir, stat_threads, return_expected, verbose, return_stats, use_cache: see find_missing_files_v1.
 
     Returns:
-        list: List of missing file names.
+        dict: 'missing_files' (frozenset), 'expected_files' (tuple) and, with return_stats,
+            'present_stats' (dict), see find_missing_files_v1.
 
     Example:
         startDatetime = '2018-07-01T00:00:00'
         endDatetime = '2018-07-02T00:00:00'
         file_prefix = 'CAMS-GLOB-ANT_v5.1_'+CAMSorigName+'_MergedNEI2017WDKadjusted'
-        missing_files = find_missing_files_v2(startDatetime, endDatetime, file_prefix)
-        print(missing_files)  # Print the missing files.
+        missing_files = find_missing_files_v2(startDatetime, endDatetime, filedir, file_prefix, '.nc', verbose=True)
     """
 
     # Convert startDatetime and endDatetime strings to datetime objects
-    start_date = datetime.strptime(startDatetime, '%Y-%m-%dT%H:%M:%S')
-    end_date = datetime.strptime(endDatetime, '%Y-%m-%dT%H:%M:%S')
-
-    # Create a list of expected file names between start and end dates
-    current_date = start_date
-    expected_files = []
-    while current_date <= end_date:
-        file_name = file_prefix + current_date.strftime('_%Y-%m-%dT%H:00:00') + file_sufix
-        expected_files.append(filedir+file_name)
-        current_date += timedelta(hours=1)
-
-    # Check if each file exists, and store the missing files in a list
-    missing_files = []
-    for file_path in expected_files:
-        try:
-            # Check if the file exists
-            with open(file_path, 'r'):
-                pass
-        except FileNotFoundError:
-            missing_files.append(file_path)
+    start_date = _to_datetime(startDatetime, '%Y-%m-%dT%H:%M:%S')
+    end_date = _to_datetime(endDatetime, '%Y-%m-%dT%H:%M:%S')
 
-    #-----------
-    # Print the missing files
-    if len(missing_files)!=0:
-        print("Missing files:")
-        for file_name in missing_files:
-            print(file_name)
-    else:
-        print("No missing files found.")
-            
-    return {'missing_files':missing_files,'expected_files':expected_files}
\ No newline at end of file
+    return _find_missing(start_date, end_date, filedir, file_prefix, file_sufix, date_sep='T',
+                         scan_dir=scan_dir, stat_threads=stat_threads, return_expected=return_expected,
+                         verbose=verbose, return_stats=return_stats, use_cache=use_cache)
+
+### asynchronous check, for use inside an asyncio event loop (e.g., Jupyter)
+async def find_missing_files_async(find_missing_files, *args, **kwargs):
+    """
+    Run find_missing_files_v1 or find_missing_files_v2 without blocking the event loop.
+
+    The whole check runs in one thread of the default executor, with the same
+    arguments and result as the synchronous call.
+
+    Parameters:
+        find_missing_files (function): find_missing_files_v1 or find_missing_files_v2.
+        *args, **kwargs: Arguments of find_missing_files.
+
+    Returns:
+        dict: Same as find_missing_files_v1/v2.
+
+    Example:
+        result = await find_missing_files_async(find_missing_files_v1, startDatetime, endDatetime,
+                                                filedir, file_prefix)
+        missing_files = result['missing_files']
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(find_missing_files, *args, **kwargs))